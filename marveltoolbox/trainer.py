@@ -1,22 +1,66 @@
 import torch 
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
 import torchvision as tv
 from torchvision.utils import save_image
 import numpy as np
 import os
+import io
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import traceback
+import pickle
+from contextlib import nullcontext
 from marveltoolbox import utils
-import shutil
 
 
-def save_checkpoint(state, is_best, file_path='./', flag=''):
+def _replace_file(file_name, data):
+    # write a sibling temp file and rename it over the target: a checkpoint
+    # loaded with mmap=True keeps mapping the old inode instead of seeing it
+    # truncated/rewritten, and a crash never leaves a half-written checkpoint
+    tmp_file_name = '{}.tmp'.format(file_name)
+    try:
+        with open(tmp_file_name, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+def _write_checkpoint(state, file_name, best_file_name=None):
+    # serialize once in memory, then dump the buffer with a single write per file
+    buf = io.BytesIO()
+    torch.save(state, buf)
+    data = buf.getbuffer()
+    _replace_file(file_name, data)
+    if best_file_name is not None:
+        _replace_file(best_file_name, data)
+
+def save_checkpoint(state, is_best, file_path='./', flag='', checkpointer=None):
     file_name = os.path.join(file_path, 'checkpoint_{}.pth.tar'.format(flag))
-    torch.save(state, file_name)
+    best_file_name = None
     if is_best:
         best_file_name = os.path.join(file_path, 'model_best_{}.pth.tar'.format(flag))
-        shutil.copyfile(file_name, best_file_name)
+    if checkpointer is None:
+        _write_checkpoint(state, file_name, best_file_name)
+    else:
+        checkpointer.submit(_write_checkpoint, state, file_name, best_file_name)
+
+_TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+
+def _load_checkpoint_file(chkpt_file):
+    if _TORCH_VERSION >= (2, 1):
+        try:
+            # map storages from disk and skip arbitrary unpickling
+            return torch.load(chkpt_file, map_location='cpu', mmap=True, weights_only=True)
+        except (pickle.UnpicklingError, RuntimeError):
+            # records with non-tensor objects, or a legacy (non-zip) checkpoint
+            pass
+    return torch.load(chkpt_file, lambda storage, loc: storage, weights_only=False)
 
 def load_checkpoint(is_best, file_path='./', flag=''):
     checkpoint = None
@@ -27,7 +71,7 @@ def load_checkpoint(is_best, file_path='./', flag=''):
 
     if os.path.isfile(chkpt_file):
         print("=> loading checkpoint '{}'".format(chkpt_file))
-        checkpoint = torch.load(chkpt_file, lambda storage, loc: storage, weights_only=False)
+        checkpoint = _load_checkpoint_file(chkpt_file)
     else:
         print("=> no checkpoint found at '{}'".format(chkpt_file))
     return checkpoint
@@ -44,7 +88,19 @@ class BaseTrainer():
         self.epochs = confs.epochs
         self.seed = confs.seed
         self.device_ids = confs.device_ids
-        self.dataloader_num_workers = 4
+        self.dataloader_num_workers = getattr(confs, 'num_workers', None)
+        if self.dataloader_num_workers is None:
+            self.dataloader_num_workers = self._auto_num_workers()
+        self.prefetch_factor = getattr(confs, 'prefetch_factor', 2)
+        self.memory_format = getattr(confs, 'memory_format', torch.contiguous_format)
+        self.amp_dtype = getattr(confs, 'amp_dtype', None)
+        self.log_every = getattr(confs, 'log_every', 1)
+        # loss scaling is only needed for float16, bfloat16 keeps the fp32 range
+        use_scaler = self.amp_dtype == torch.float16 and torch.device(self.device).type == 'cuda'
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+        else:  # torch < 2.3
+            self.scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
         self.start_epoch = 0
         self.schedulers = {}
         self.models = {}
@@ -53,10 +109,16 @@ class BaseTrainer():
         self.train_sets = {}
         self.eval_sets = {}
         self.dataloaders = {}
+        self.prefetchers = {}
+        self.samplers = {}
         self.records = {}
         self.logs = {}
         self.model_names = self.models.keys()
         self.logger = None
+        self._log_listener = None
+        self._ckpt = utils.AsyncCheckpointer()
+        self._ckpt_staging = {}
+        self._ckpt_stream = None
 
         if not os.path.exists(self.chkpt_path):
             print(self.chkpt_path, 'dose not exist')
@@ -67,6 +129,7 @@ class BaseTrainer():
             os.makedirs(self.log_path)
 
     def set_logger(self):
+        self.close_logger()
         self.logger = logging.getLogger(__name__) 
         self.logger.handlers = []
         self.logger.setLevel(logging.INFO)
@@ -74,23 +137,81 @@ class BaseTrainer():
         log_file = os.path.join(self.log_path, log_file_name)
         print('Log file save at: ', log_file)
         hfile = logging.FileHandler(log_file)
-        self.logger.addHandler(hfile)
+        # records are queued and written to the file by a listener thread
+        log_queue = queue.Queue(-1)
+        self._log_listener = QueueListener(log_queue, hfile)
+        self._log_listener.start()
+        self.logger.addHandler(QueueHandler(log_queue))
 
-    def preprocessing(self):
-        kwargs = {'num_workers': self.dataloader_num_workers, 'drop_last': True, 'pin_memory': True} if torch.cuda.is_available() else {}
-        for key in self.datasets.keys():
-            self.dataloaders[key] = torch.utils.data.DataLoader(
-                self.datasets[key], batch_size=self.batch_size, shuffle=True, **kwargs)
+    def close_logger(self):
+        # flush the queued records, later records are written to the file directly
+        if self._log_listener is None:
+            return
+        self._log_listener.stop()
+        if self.logger is not None:
+            self.logger.handlers = list(self._log_listener.handlers)
+        self._log_listener = None
 
-        for key in self.train_sets.keys():
-            self.dataloaders[key] = torch.utils.data.DataLoader(
-                self.train_sets[key], batch_size=self.batch_size, shuffle=True, **kwargs)
+    def _auto_num_workers(self):
+        # split the cores between the visible devices, capped at 8:
+        # loader throughput saturates early and >16 workers usually regresses
+        if hasattr(os, 'sched_getaffinity'):
+            # respect taskset/scheduler CPU limits, not the host core count
+            cpu_count = len(os.sched_getaffinity(0))
+        else:
+            cpu_count = os.cpu_count() or 1
+        return min(8, max(2, cpu_count // max(1, len(self.device_ids))))
 
-        kwargs = {'num_workers': self.dataloader_num_workers, 'drop_last': False, 'pin_memory': True} if torch.cuda.is_available() else {}
+    def _dataloader_kwargs(self, drop_last):
+        if not torch.cuda.is_available():
+            return {}
+        kwargs = {'num_workers': self.dataloader_num_workers, 'drop_last': drop_last, 'pin_memory': True}
+        if self.dataloader_num_workers > 0:
+            # keep workers alive across epochs/eval passes instead of re-forking them
+            kwargs['persistent_workers'] = True
+            kwargs['prefetch_factor'] = self.prefetch_factor
+        return kwargs
+
+    def preprocessing(self):
+        kwargs = self._dataloader_kwargs(drop_last=True)
+        is_distributed = dist.is_available() and dist.is_initialized()
+        train_sets = {**self.datasets, **self.train_sets}
+        for key, dataset in train_sets.items():
+            if is_distributed:
+                # the sampler shuffles and shards, so the loader itself must not shuffle
+                self.samplers[key] = DistributedSampler(dataset, shuffle=True)
+                self.dataloaders[key] = torch.utils.data.DataLoader(
+                    dataset, batch_size=self.batch_size, shuffle=False, sampler=self.samplers[key], **kwargs)
+            else:
+                self.dataloaders[key] = torch.utils.data.DataLoader(
+                    dataset, batch_size=self.batch_size, shuffle=True, **kwargs)
+
+        kwargs = self._dataloader_kwargs(drop_last=False)
         for key in self.eval_sets.keys():
             self.dataloaders[key] = torch.utils.data.DataLoader(
-                self.eval_sets[key], batch_size=self.batch_size, shuffle=True, **kwargs)
-        
+                self.eval_sets[key], batch_size=self.batch_size, shuffle=False, **kwargs)
+
+        if torch.device(self.device).type == 'cuda':
+            for key, loader in self.dataloaders.items():
+                if loader.pin_memory:
+                    self.prefetchers[key] = utils.CUDAPrefetcher(loader, self.device)
+
+    def to_device(self, x):
+        # only 4D (NCHW) batches can take the channels_last layout
+        if x.dim() == 4:
+            return x.to(self.device, memory_format=self.memory_format, non_blocking=True)
+        return x.to(self.device, non_blocking=True)
+
+    def autocast(self):
+        # usage in subclasses:
+        #     with self.autocast():
+        #         loss = ...
+        #     self.scaler.scale(loss).backward()
+        #     self.scaler.step(optim); self.scaler.update()
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(torch.device(self.device).type, dtype=self.amp_dtype)
+
     def train(self, epoch):
         return 0.0
                 
@@ -101,12 +222,12 @@ class BaseTrainer():
         pass
 
     def print_logs(self, epoch, step):
-        print_str = 'Epoch/Iter:{:0>3d}/{:0>4d} '.format(epoch, step)
-        for key, value in self.logs.items():
-            if type(value) == str:
-                print_str += '{}:{} '.format(key, value)
-            else:
-                print_str += '{}:{:4f} '.format(key, value)
+        if step % self.log_every != 0:
+            return
+        parts = [f'Epoch/Iter:{epoch:0>3d}/{step:0>4d}']
+        parts.extend(f'{key}:{value}' if isinstance(value, str) else f'{key}:{value:4f}'
+                     for key, value in self.logs.items())
+        print_str = ' '.join(parts)
         print(print_str)
         if self.logger is not None:
             self.logger.info(print_str)
@@ -116,15 +237,21 @@ class BaseTrainer():
         self.set_logger()
         if not retrain:
             self.load()
+        for name in self.models.keys():
+            self.models[name] = self.models[name].to(memory_format=self.memory_format)
         self.timer = utils.Timer(self.epochs-self.start_epoch, self.logger)
         self.timer.init()
         for epoch in range(self.start_epoch, self.epochs):
+            for sampler in self.samplers.values():
+                sampler.set_epoch(epoch)
             loss = self.train(epoch)
             is_best = self.eval(epoch)
             self.timer.step()
             self.save(is_best=is_best)
             self.start_epoch += 1
             self.scheduler_step()
+        # surface a failed final write here, so run() logs it
+        self._ckpt.wait()
 
         if load_best:
             self.load(is_best=True)
@@ -134,6 +261,7 @@ class BaseTrainer():
                 self.logger.info(print_str)
                 
         if is_del_loger:
+            self.close_logger()
             del self.logger
             self.logger = None
 
@@ -145,37 +273,53 @@ class BaseTrainer():
             print(print_str)
             if self.logger is not None:
                 self.logger.info(print_str)
+        finally:
+            # safety net, main() normally waits for the last write itself
+            self._ckpt.wait()
+            self.close_logger()
             
+    def _ckpt_groups(self):
+        # looked up on each call, subclasses may rebind these dicts after __init__
+        return {'optim': self.optims, 'model': self.models, 'scheduler': self.schedulers}
+
     def save(self, is_best=False):
         state_dict = {}
         state_dict['epoch'] = self.start_epoch + 1
         state_dict['records'] = self.records
 
-        for name, optim in self.optims.items():
-            state_dict['optim_{}'.format(name)] = self.optims[name].state_dict()
-        
-        for name, model in self.models.items():
-            state_dict['model_{}'.format(name)] = self.models[name].state_dict()
-
-        for name, scheduler in self.schedulers.items():
-            state_dict['scheduler_{}'.format(name)] = self.schedulers[name].state_dict()
+        for prefix, objs in self._ckpt_groups().items():
+            for name, obj in objs.items():
+                state_dict[f'{prefix}_{name}'] = obj.state_dict()
+        if self.scaler.is_enabled():
+            state_dict['scaler'] = self.scaler.state_dict()
 
-        save_checkpoint(state_dict, is_best, file_path=self.chkpt_path, flag=self.save_flag)
+        # the staging buffers may still be read by the previous background write
+        self._ckpt.wait()
+        if torch.device(self.device).type == 'cuda':
+            if self._ckpt_stream is None:
+                self._ckpt_stream = torch.cuda.Stream(device=self.device)
+            self._ckpt_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self._ckpt_stream):
+                # only copies from self.device run on the side stream and are async
+                state_dict = utils.state_dict_to_cpu(state_dict, self._ckpt_staging, device=self.device)
+            self._ckpt_stream.synchronize()
+        else:
+            state_dict = utils.state_dict_to_cpu(state_dict, self._ckpt_staging)
+        save_checkpoint(state_dict, is_best, file_path=self.chkpt_path, flag=self.save_flag, checkpointer=self._ckpt)
         
     def load(self, is_best=False):
+        self._ckpt.wait()
         chkpt = load_checkpoint(is_best, file_path=self.chkpt_path, flag=self.save_flag)
         if chkpt:
             self.start_epoch = chkpt['epoch']
             self.records = chkpt['records']
 
-            for name, optim in self.optims.items():
-                self.optims[name].load_state_dict(chkpt['optim_{}'.format(name)])
-            
-            for name, model in self.models.items():
-                self.models[name].load_state_dict(chkpt['model_{}'.format(name)])
-
-            for name, scheduler in self.schedulers.items():
-                self.schedulers[name].load_state_dict(chkpt['scheduler_{}'.format(name)])
+            for prefix, objs in self._ckpt_groups().items():
+                for name, obj in objs.items():
+                    obj.load_state_dict(chkpt[f'{prefix}_{name}'])
+            # older checkpoints and non-float16 runs have no scaler state
+            if self.scaler.is_enabled() and 'scaler' in chkpt:
+                self.scaler.load_state_dict(chkpt['scaler'])
             print_str = "=> loaded checkpoint (epoch {})".format(chkpt['epoch'])
             print(print_str)
             if self.logger is not None:
@@ -2,6 +2,7 @@ from .utils import *
 from .plot import *
 from .seed import set_seed
 from .timer import Timer
+from .prefetcher import CUDAPrefetcher
 from .torch_complex import *
 from .signal_processing import *
 from .peft import *
\ No newline at end of file
@@ -0,0 +1,71 @@
+import torch
+
+
+def _to_device(batch, device):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, tuple) and hasattr(batch, '_fields'):
+        # namedtuple, kept as such by default_collate
+        return type(batch)(*(_to_device(b, device) for b in batch))
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(b, device) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _to_device(v, device) for k, v in batch.items()}
+    return batch
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+
+
+class CUDAPrefetcher:
+    """
+    Wrap a DataLoader so that the host-to-device copy of the next batch runs
+    on a side CUDA stream while the model works on the current one.
+    Works best with pin_memory=True; falls back to plain copies on CPU.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self._iter = None
+        self._next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self._iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self._iter)
+        except StopIteration:
+            self._next_batch = None
+            return
+        if self.stream is None:
+            self._next_batch = _to_device(batch, self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                self._next_batch = _to_device(batch, self.device)
+
+    def __next__(self):
+        if self._next_batch is None:
+            raise StopIteration
+        batch = self._next_batch
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # tensors were allocated on the side stream, tell the allocator
+            # they are now used by the compute stream
+            _record_stream(batch, current_stream)
+        self._preload()
+        return batch
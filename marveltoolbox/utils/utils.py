@@ -1,5 +1,6 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 import torch.nn as nn
@@ -7,6 +8,10 @@ import torch.nn.functional as F
 import torchvision as tv
 import matplotlib.pyplot as plt
 from torch.distributions import MultivariateNormal
+try:
+    from torch.func import jacrev
+except ImportError:  # torch < 2.0
+    jacrev = None
 
 def params_count(model):
     """
@@ -14,34 +19,88 @@ def params_count(model):
     Args:
         model (model): model to count the number of parameters.
     """
-    return np.sum([p.numel() for p in model.parameters()]).item()
+    return sum(p.numel() for p in model.parameters())
+
+def state_dict_to_cpu(state, staging=None, prefix='', device=None):
+    """
+    Recursively copy every tensor of a (nested) state dict to CPU memory, so
+    the snapshot is not affected by later in-place updates of the training loop.
+    Args:
+        state (dict): state dict to copy.
+        staging (dict): optional cache of CPU buffers, reused across calls.
+            Buffers of CUDA tensors are pinned.
+        device (torch.device): CUDA device whose tensors are copied with
+            non_blocking=True into the staging buffers; the caller must
+            synchronize it before reading them. Tensors on any other device
+            are copied synchronously.
+    """
+    if torch.is_tensor(state):
+        if staging is None:
+            return state.detach().to('cpu', copy=True)
+        buf = staging.get(prefix)
+        if buf is None or buf.shape != state.shape or buf.dtype != state.dtype:
+            buf = torch.empty(state.shape, dtype=state.dtype, pin_memory=state.is_cuda)
+            staging[prefix] = buf
+        non_blocking = device is not None and state.device == torch.device(device)
+        return buf.copy_(state.detach(), non_blocking=non_blocking)
+    if isinstance(state, dict):
+        return {k: state_dict_to_cpu(v, staging, '{}.{}'.format(prefix, k), device) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        values = (state_dict_to_cpu(v, staging, '{}.{}'.format(prefix, i), device) for i, v in enumerate(state))
+        if hasattr(state, '_fields'):
+            # namedtuple, its constructor takes the fields positionally
+            return type(state)(*values)
+        return type(state)(values)
+    return state
+
+
+class AsyncCheckpointer:
+    """
+    Serialize and write checkpoints on a background thread.
+    At most one write is in flight; a new save waits for the previous one.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def submit(self, fn, *args, **kwargs):
+        self.wait()
+        self.future = self.executor.submit(fn, *args, **kwargs)
+        return self.future
+
+    def wait(self):
+        # re-raises any exception from the background write
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
 
 def separate_bn_paras(modules):
     if not isinstance(modules, list):
-        modules = [*modules.modules()]
+        modules = [modules]
     paras_only_bn = []
     paras_wo_bn = []
-    for layer in modules:
-        if 'model' in str(layer.__class__):
-            continue
-        if 'container' in str(layer.__class__):
-            continue
-        else:
-            if 'batchnorm' in str(layer.__class__):
-                paras_only_bn.extend([*layer.parameters()])
+    seen = set()
+    for module in modules:
+        for layer in module.modules():
+            # only the layer's own parameters, children are visited on their own
+            paras = [p for p in layer.parameters(recurse=False) if id(p) not in seen]
+            seen.update(id(p) for p in paras)
+            if isinstance(layer, nn.modules.batchnorm._BatchNorm):
+                paras_only_bn.extend(paras)
             else:
-                paras_wo_bn.extend([*layer.parameters()])
+                paras_wo_bn.extend(paras)
     return paras_only_bn, paras_wo_bn
 
 
-def get_jacobian(fun, x, noutputs):
+def _legacy_get_jacobian(fun, x, noutputs):
     x_size = list(x.size())
     x = x.unsqueeze(0).repeat(noutputs, *([1]*(len(x_size))) ).detach().requires_grad_(True)
     y = fun(x)
     y.backward(torch.eye(noutputs))
     return x.grad.view(noutputs,*x_size)
 
-def Hessian_matrix(fun,x):
+def _legacy_Hessian_matrix(fun,x):
     #y is a scalar Tensor
     def get_grad(xx):
         y = fun(xx)
@@ -49,38 +108,76 @@ def Hessian_matrix(fun,x):
         return grad
         
     x_size = x.numel()
-    return get_jacobian(get_grad, x, x_size)
+    return _legacy_get_jacobian(get_grad, x, x_size)
+
+def _needs_full_batch(fun):
+    # BatchNorm in train mode cannot run on a batch of one (nor under jacrev)
+    return isinstance(fun, nn.Module) and any(
+        isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training for m in fun.modules())
+
+def get_jacobian(fun, x, noutputs):
+    # fun works on a batch; it is evaluated on a batch of one sample, except
+    # for modules with train-mode BatchNorm which use the legacy batch of noutputs
+    if jacrev is None or _needs_full_batch(fun):
+        return _legacy_get_jacobian(fun, x, noutputs)
+    return jacrev(lambda xx: fun(xx.unsqueeze(0)).squeeze(0))(x.detach()).detach()
+
+def Hessian_matrix(fun,x):
+    #y is a scalar Tensor
+    if jacrev is None or _needs_full_batch(fun):
+        return _legacy_Hessian_matrix(fun, x)
+    H = jacrev(jacrev(lambda xx: fun(xx.unsqueeze(0)).sum()))(x.detach()).detach()
+    return H.reshape(x.numel(), *x.size())
 
 def analyze_latent_space(z, y, class_num=2):
+    z = z.detach()
+    y = y.to(z.device)
+    D = z.size(1)
+    counts = torch.bincount(y, minlength=class_num).clamp_min_(1).to(z.dtype)
+    mu = torch.zeros(class_num, D, device=z.device, dtype=z.dtype).index_add_(0, y, z) / counts[:, None]
+    centered = z - mu[y]
+    mask = F.one_hot(y, num_classes=class_num).to(z.dtype)
+    var = torch.einsum('nc,nd,ne->cde', mask, centered, centered) / counts[:, None, None]
     gaussians = []
     for c in range(class_num):
-        idx = y.eq(c).nonzero().view(-1)
-        n = len(idx)
-        z_c = z[idx]
-        mu_c = torch.mean(z_c, dim=0, keepdim=True)
-        v_c = z_c-mu_c.repeat(n, 1)
-        var_c = 1/n * v_c.transpose(0, 1).matmul(v_c)
-        gaussian = MultivariateNormal(loc=mu_c.clone().detach(), covariance_matrix=var_c.clone().detach())
+        gaussian = MultivariateNormal(loc=mu[c:c+1], covariance_matrix=var[c])
         gaussians.append(gaussian)
     return gaussians
 
+def batch_gaussians(gaussians):
+    """
+    Stack a list of per-class MultivariateNormal into a single batched one
+    with loc (C, D) and scale_tril (C, D, D), reusing their Cholesky factors.
+    """
+    loc = torch.stack([g.loc.reshape(-1) for g in gaussians])
+    scale_tril = torch.stack([g.scale_tril.reshape(loc.size(1), loc.size(1)) for g in gaussians])
+    return MultivariateNormal(loc=loc, scale_tril=scale_tril)
+
 def log_pz(z, y, gaussians, device):
-    n, c = len(z), len(gaussians)
-    V = torch.zeros(n, c, device=device)
-    mask = F.one_hot(y, num_classes=c).type_as(z).to(device)
-    for i in range(c): 
-        V[:, i] = gaussians[i].log_prob(z)
-    A = V*mask
-    A = torch.sum(A, dim=1)
-    return A.view(n, -1)
-
-def sample(n, netD, gaussians):    
-    samples = []
-    K = len(gaussians)
-    for i in range(n):
-        idx = np.random.choice(np.arange(K))
-        samples.append(gaussians[idx].sample())
-    sample_z = torch.cat(samples, dim=0).to(device)
+    # a batched MultivariateNormal (see batch_gaussians) can be passed to skip re-stacking
+    if not isinstance(gaussians, MultivariateNormal):
+        gaussians = batch_gaussians(gaussians)
+    n, c = len(z), gaussians.loc.size(0)
+    V = gaussians.log_prob(z.unsqueeze(1).expand(-1, c, -1))
+    A = V.gather(1, y.to(V.device).view(-1, 1))
+    return A.view(n, -1).to(device)
+
+def sample(n, netD, gaussians, device=None):
+    # pass device (e.g. trainer.device) to skip looking it up on every call
+    if not isinstance(gaussians, MultivariateNormal):
+        gaussians = batch_gaussians(gaussians)
+    if device is None:
+        device = next(netD.parameters()).device
+    loc, scale_tril = gaussians.loc, gaussians.scale_tril
+    K, D = loc.shape
+    idx = torch.randint(0, K, (n,), device=loc.device)
+    with torch.no_grad():
+        eps = torch.randn(n, D, device=loc.device, dtype=loc.dtype)
+        # transform eps by every component in one GEMM, (n, K, D), then pick each
+        # sample's own component; avoids an (n, D, D) gather of scale_tril
+        z = torch.einsum('kde,ne->nkd', scale_tril, eps)
+        z = z.gather(1, idx.view(n, 1, 1).expand(-1, 1, D)).squeeze(1)
+        sample_z = (loc[idx] + z).to(device)
     sample_x = netD(sample_z)
     return sample_x
 
@@ -90,12 +187,10 @@ def one_hot_encode(labels, n_labels):
     Transforms numeric labels to 1-hot encoded labels. Assumes numeric labels are in the range 0, 1, ..., n_labels-1.
     """
 
+    labels = np.asarray(labels)
     assert np.min(labels) >= 0 and np.max(labels) < n_labels
 
-    y = np.zeros([labels.size, n_labels])
-    y[range(labels.size), labels] = 1
-
-    return y
+    return np.eye(n_labels, dtype=np.float32)[labels]
 
 def logit(x):
     """
@@ -103,4 +198,5 @@ def logit(x):
     :param x: numpy array
     :return: numpy array
     """
-    return np.log(x / (1.0 - x))
\ No newline at end of file
+    x = np.asarray(x)
+    return np.log(x) - np.log1p(-x)
\ No newline at end of file